@@ -6,7 +6,7 @@ import jax.numpy as np
 import jax.scipy.stats
 import jax.scipy.linalg
 import numpyro.distributions as dist
-from numpyro_stein.util import sqrth
+from numpyro_stein.util import sqrth, sq_dists
 
 class PrecondMatrix(ABC):
     @abstractmethod
@@ -37,6 +37,25 @@ class SteinKernel(ABC):
         """
         raise NotImplementedError
 
+    @property
+    def traceable(self):
+        """
+        Returns whether `compute` only draws on JAX operations, so the kernel can be computed in a jitted function (default True).
+        Kernels that draw host-side random numbers in `compute` are not traceable, as the numbers would be fixed at compilation.
+        """
+        return True
+
+    def compute_batched(self, particles: np.ndarray, particle_info: Dict[str, Tuple[int, int]], loss_fn: Callable[[np.ndarray], float]):
+        """
+        Computes a batched 'norm' kernel function given the input Stein particles, which evaluates the kernel
+        between all pairs of particles in batches of shape N x D and M x D giving an N x M matrix.
+        Returns None (default) if the kernel has no batched form, in which case the kernel from `compute` is used.
+        :param particles: The Stein particles to compute the kernel from
+        :param particle_info: A mapping from parameter names to the position in the particle matrix
+        :param loss_fn: Loss function given particles
+        """
+        return None
+
 class RBFKernel(SteinKernel):
     """
     Calculates the Gaussian RBF kernel function with median bandwidth.
@@ -56,7 +75,11 @@ class RBFKernel(SteinKernel):
     def _normed(self):
         return self._mode == 'norm' or (self.mode == 'matrix' and self.matrix_mode == 'norm_diag')
 
-    def compute(self, particles, particle_info, loss_fn):
+    def bandwidth(self, particles):
+        """
+        Computes the median bandwidth of the kernel given the input Stein particles
+        :param particles: The Stein particles to compute the bandwidth from
+        """
         if self._normed() and particles.ndim >= 2:
             particles = np.linalg.norm(particles, ord=2, axis=-1) # N x D -> N
         dists = np.expand_dims(particles, axis=0) - np.expand_dims(particles, axis=1) # N x N (x D)
@@ -66,6 +89,10 @@ class RBFKernel(SteinKernel):
         bandwidth = np.abs(dists)[median] ** 2 * factor + 1e-5
         if self._normed():
             bandwidth = bandwidth[0]
+        return bandwidth
+
+    def compute(self, particles, particle_info, loss_fn):
+        bandwidth = self.bandwidth(particles)
         def kernel(x, y):
             diff = np.linalg.norm(x - y, ord=2) if self._normed() and x.ndim >= 1 else x - y
             kernel_res = np.exp (- diff ** 2 / bandwidth)
@@ -78,6 +105,14 @@ class RBFKernel(SteinKernel):
                 return kernel_res
         return kernel
 
+    def compute_batched(self, particles, particle_info, loss_fn):
+        if self._mode != 'norm':
+            return None
+        bandwidth = self.bandwidth(particles)
+        def kernel(xs, ys):
+            return np.exp(- sq_dists(xs, ys) / bandwidth)
+        return kernel
+
     @property
     def mode(self):
         return self._mode
@@ -108,6 +143,13 @@ class IMQKernel(SteinKernel):
             return (np.array(self.const) ** 2 + diff ** 2) ** self.expon
         return kernel
 
+    def compute_batched(self, particles, particle_info, loss_fn):
+        if self._mode != 'norm':
+            return None
+        def kernel(xs, ys):
+            return (np.array(self.const) ** 2 + sq_dists(xs, ys)) ** self.expon
+        return kernel
+
 class LinearKernel(SteinKernel):
     """
     Calculates the linear kernel, from "Stein Variational Gradient Descent as Moment Matching" by Liu and Wang
@@ -147,6 +189,10 @@ class RandomFeatureKernel(SteinKernel):
     def mode(self):
         return self._mode
 
+    @property
+    def traceable(self):
+        return self.bandwidth_subset is None
+
     def compute(self, particles, particle_info, loss_fn):
         if self._random_weights is None:
             self._random_weights = np.array(onpr.randn(*particles.shape))
@@ -185,6 +231,10 @@ class MixtureKernel(SteinKernel):
     def mode(self):
         return self.kernel_fns[0].mode
 
+    @property
+    def traceable(self):
+        return all(kf.traceable for kf in self.kernel_fns)
+
     def compute(self, particles, particle_info, loss_fn):
         kernels = [kf.compute(particles, particle_info, loss_fn) for kf in self.kernel_fns]
         def kernel(x, y):
@@ -223,6 +273,10 @@ class PrecondMatrixKernel(SteinKernel):
     def mode(self):
         return 'matrix'
 
+    @property
+    def traceable(self):
+        return self.inner_kernel_fn.traceable
+
     def compute(self, particles, particle_info, loss_fn):
         qs = self.precond_matrix_fn.compute(particles, loss_fn)
         if self.precond_mode == 'const':
@@ -255,6 +309,10 @@ class GraphicalKernel(SteinKernel):
     def mode(self):
         return 'matrix'
 
+    @property
+    def traceable(self):
+        return self.default_kernel_fn.traceable and all(kf.traceable for kf in self.local_kernel_fns.values())
+
     def compute(self, particles, particle_info, loss_fn):
         local_kernels = []
         for pk, (start_idx, end_idx) in particle_info.items():
@@ -1,13 +1,13 @@
-from functools import namedtuple
+from functools import namedtuple, partial
+from itertools import chain
 from numpyro import handlers
 from numpyro.distributions import constraints
 from numpyro.distributions.transforms import biject_to
 from numpyro.infer import NUTS, MCMC
 from numpyro.infer.util import transform_fn, log_density
-from numpyro.util import fori_loop
 from numpyro_stein.guides import ReinitGuide
-from numpyro_stein.stein.kernels import SteinKernel
-from numpyro_stein.util import ravel_pytree
+from numpyro_stein.stein.kernels import SteinKernel, RBFKernel
+from numpyro_stein.util import ravel_pytree, sq_dists
 from typing import Callable
 import tqdm
 
@@ -15,7 +15,7 @@ import jax
 import jax.random
 import jax.numpy as np
 from jax import ops
-from jax.tree_util import tree_map
+from jax.tree_util import tree_flatten, tree_map
 
 # TODO, next steps.
 # * Implement Stein Point MCMC updates:
@@ -32,6 +32,101 @@ from jax.tree_util import tree_map
 
 SVGDState = namedtuple('SVGDState', ['optim_state', 'rng_key'])
 
+# Largest particle dimension for which 'auto' force mode differentiates the kernel in forward mode
+_FWD_FORCE_MODE_MAX_DIM = 256
+
+def _batched_kernel(kernel):
+    """
+    Lifts a pairwise kernel function `kernel(x, y)` to a function `kernel(xs, y)` that evaluates
+    the kernel between each particle in `xs` and `y`.
+    :param kernel: The pairwise kernel function computed by :meth:`SteinKernel.compute`
+    """
+    return jax.vmap(kernel, in_axes=(0, None))
+
+def _tiled_vmap(fn, tile_size):
+    """
+    Vectorizes `fn` over the leading axis of its arguments like :func:`jax.vmap`, but evaluates
+    tiles of `tile_size` rows one after another with :func:`jax.lax.scan` to bound the memory used at once.
+    :param fn: The function to vectorize
+    :param tile_size: The number of rows in each tile (must evenly divide the leading axis)
+    """
+    def tiled_fn(*xs):
+        tiles = tree_map(lambda x: np.reshape(x, (-1, tile_size, *x.shape[1:])), xs)
+        _, res = jax.lax.scan(lambda carry, tile: (carry, jax.vmap(fn)(*tile)), (), tiles)
+        return tree_map(lambda r: np.reshape(r, (-1, *r.shape[2:])), res)
+    return tiled_fn
+
+def _is_array_tree(x):
+    # Whether every leaf of the pytree `x` is an array (including tracers), so `x` can be passed to a jitted function
+    leaves, _ = tree_flatten(x)
+    return all(isinstance(leaf, np.ndarray) for leaf in leaves)
+
+def _jit_model_args(fn, num_array_args):
+    """
+    Jits `fn`, whose first `num_array_args` arguments are always traced and whose remaining arguments and keyword
+    arguments are passed on to the model / guide. Model arguments that are not arrays, e.g. Python ints used as shapes,
+    are closed over as static values, so `fn` is compiled once for each combination of them.
+    Calls with static values that are not hashable fall back to calling `fn` without compiling it.
+    :param fn: The function to compile
+    :param num_array_args: The number of leading arguments of `fn` that are always traced
+    """
+    compiled_fns = {}
+
+    def compile_fn(num_model_args, static_args, static_kwargs):
+        static_args = dict(static_args)
+        static_kwargs = dict(static_kwargs)
+        def array_fn(array_args, dynamic_args, dynamic_kwargs):
+            dynamic_args = iter(dynamic_args)
+            model_args = [static_args[i] if i in static_args else next(dynamic_args) for i in range(num_model_args)]
+            return fn(*array_args, *model_args, **dynamic_kwargs, **static_kwargs)
+        return jax.jit(array_fn)
+
+    def jitted_fn(*args, **kwargs):
+        array_args, model_args = args[:num_array_args], args[num_array_args:]
+        static_args = tuple((i, arg) for i, arg in enumerate(model_args) if not _is_array_tree(arg))
+        static_kwargs = tuple(sorted((k, v) for k, v in kwargs.items() if not _is_array_tree(v)))
+        key = (len(model_args), static_args, static_kwargs)
+        try:
+            compiled_fn = compiled_fns.get(key)
+        except TypeError:
+            return fn(*args, **kwargs)
+        if compiled_fn is None:
+            compiled_fn = compiled_fns[key] = compile_fn(*key)
+        static_idxs = frozenset(i for i, _ in static_args)
+        dynamic_args = tuple(arg for i, arg in enumerate(model_args) if i not in static_idxs)
+        dynamic_kwargs = {k: v for k, v in kwargs.items() if _is_array_tree(v)}
+        return compiled_fn(array_args, dynamic_args, dynamic_kwargs)
+    return jitted_fn
+
+def _make_loss_fn(svgd, jit=True):
+    """
+    Builds a version of :meth:`SVGD._svgd_loss_and_grads` taking `(rng_key, unconstr_params, *args, **kwargs)`,
+    which is jitted using :func:`_jit_model_args`. The temperatures of `svgd` are passed to the compiled function
+    as arrays, while its model, guide, kernel and static keyword arguments are fixed when the function is compiled.
+    :param svgd: The :class:`SVGD` instance to compile the loss and gradients for.
+    :param jit: Whether to jit the function (default True).
+    """
+    def loss_fn(rng_key, unconstr_params, loss_temperature, repulsion_temperature, *args, **kwargs):
+        return svgd._svgd_loss_and_grads(rng_key, unconstr_params, loss_temperature, repulsion_temperature, *args, **kwargs)
+    compiled_fn = _jit_model_args(loss_fn, 4) if jit else loss_fn
+    return lambda rng_key, unconstr_params, *args, **kwargs: compiled_fn(rng_key, unconstr_params, svgd.loss_temperature,
+                                                                         svgd.repulsion_temperature, *args, **kwargs)
+
+def _make_update_fn(svgd, jit=True):
+    """
+    Builds an SVGD step taking `(optim_state, rng_key, *args, **kwargs)` that computes the loss and gradients and applies
+    the optimizer update in a single function, which is jitted like the function from :func:`_make_loss_fn`.
+    :param svgd: The :class:`SVGD` instance to compile the update for.
+    :param jit: Whether to jit the function (default True).
+    """
+    def update_fn(optim_state, rng_key, loss_temperature, repulsion_temperature, *args, **kwargs):
+        params = svgd.optim.get_params(optim_state)
+        loss_val, grads = svgd._svgd_loss_and_grads(rng_key, params, loss_temperature, repulsion_temperature, *args, **kwargs)
+        return svgd.optim.update(grads, optim_state), loss_val
+    compiled_fn = _jit_model_args(update_fn, 4) if jit else update_fn
+    return lambda optim_state, rng_key, *args, **kwargs: compiled_fn(optim_state, rng_key, svgd.loss_temperature,
+                                                                     svgd.repulsion_temperature, *args, **kwargs)
+
 # Lots of code based on SVI interface and commonalities should be refactored
 class SVGD:
     """
@@ -58,6 +153,19 @@ class SVGD:
     :param sampler_fn: The MCMC sampling kernel used for the Stein Point MCMC updates
     :param sampler_kwargs: Keyword arguments provided to the MCMC sampling kernel
     :param mcmc_kwargs: Keyword arguments provided to the MCMC interface
+    :param fast_rbf: Compute the forces of an :class:`RBFKernel` in 'norm' mode from the matrix of squared distances
+        between particles rather than from pairwise kernel evaluations
+    :param num_devices: Number of devices to shard the Stein particles across with :func:`jax.pmap`
+        (must evenly divide the number of Stein particles)
+    :param pairwise_tile: Number of particles per tile when computing the pairwise forces, so only a
+        tile x N block of kernel values is live at once (default None, meaning all particles in one block).
+        Must evenly divide the number of Stein particles per device. Setting a tile computes the forces pairwise,
+        so kernels with a batched form (see :meth:`SteinKernel.compute_batched`) do not use it, and it is ignored by `fast_rbf`.
+    :param kernel_dtype: Floating point type, e.g. `jax.numpy.bfloat16`, to compute the squared distances and kernel matrix
+        of `fast_rbf` in (default None, meaning the type of the particles). Particles are centered before they are cast,
+        and the kernel matrix is cast back to the particle type before every reduction. Requires `fast_rbf`.
+    :param force_mode: Autodiff mode for the kernel gradients of the repulsive force, either 'fwd' for forward mode,
+        'rev' for reverse mode or 'auto' (default) for forward mode on particles with fewer than 256 dimensions
     :param static_kwargs: Static keyword arguments for the model / guide, i.e. arguments
         that remain constant during fitting.
     """
@@ -67,8 +175,14 @@ class SVGD:
                  classic_guide_params_fn: Callable[[str], bool]=lambda name: False,
                  sp_mcmc_crit='infl', sp_mode='local',
                  num_mcmc_particles: int=0, num_mcmc_warmup:int=100, num_mcmc_updates:int=10,
-                 sampler_fn=NUTS, sampler_kwargs=None, mcmc_kwargs=None, **static_kwargs):
+                 sampler_fn=NUTS, sampler_kwargs=None, mcmc_kwargs=None, fast_rbf=False, num_devices: int=1, pairwise_tile: int=None, kernel_dtype=None,
+                 force_mode='auto', **static_kwargs):
         assert sp_mcmc_crit == 'infl' or sp_mcmc_crit == 'rand'
+        assert not fast_rbf or (isinstance(kernel_fn, RBFKernel) and kernel_fn.mode == 'norm')
+        assert num_devices >= 1 and num_stein_particles % num_devices == 0
+        assert pairwise_tile is None or (num_stein_particles // num_devices) % pairwise_tile == 0
+        assert kernel_dtype is None or fast_rbf
+        assert force_mode == 'auto' or force_mode == 'fwd' or force_mode == 'rev'
         assert sp_mode == 'local' or sp_mode == 'global'
         assert 0 <= num_mcmc_particles <= num_stein_particles
         self.model = model
@@ -90,25 +204,101 @@ class SVGD:
         self.sampler_fn = sampler_fn
         self.sampler_kwargs = sampler_kwargs or dict()
         self.mcmc_kwargs = mcmc_kwargs or dict()
+        self.fast_rbf = fast_rbf
+        self.num_devices = num_devices
+        self.pairwise_tile = pairwise_tile
+        self.kernel_dtype = kernel_dtype
+        self.force_mode = force_mode
         self.mcmc: MCMC = None
         self.guide_param_names = None
+        self._classic_param_names = None
+        self._stein_param_names = None
         self.constrain_fn = None
         self.uconstrain_fn = None
+        self._loss_and_grads_fn = None
+        self._update_fn = None
+        self._compiled_config = None
 
-    def _apply_kernel(self, kernel, x, y, v):
-        if self.kernel_fn.mode == 'norm' or self.kernel_fn.mode == 'vector':
-            return kernel(x, y) * v
-        else:
-            return kernel(x, y) @ v
+    def _compiled_fns(self):
+        # The compiled functions close over these, so they are rebuilt when any of them is replaced.
+        # Kernels that are not traceable are computed outside of jit on every step instead.
+        config = (self.kernel_fn.traceable, self.model, self.guide, self.loss, self.optim, self.kernel_fn, self.static_kwargs)
+        if self._compiled_config is None or any(c is not cc for c, cc in zip(config, self._compiled_config)):
+            self._loss_and_grads_fn = _make_loss_fn(self, jit=self.kernel_fn.traceable)
+            self._update_fn = _make_update_fn(self, jit=self.kernel_fn.traceable)
+            self._compiled_config = config
+        return self._loss_and_grads_fn, self._update_fn
+
+    def _map_particles(self, fn, *particles, tile_size=None):
+        # Maps fn over the leading particle axis, sharding particles across devices when more than one is used
+        vmap_fn = jax.vmap(fn) if tile_size is None else _tiled_vmap(fn, tile_size)
+        if self.num_devices == 1:
+            return vmap_fn(*particles)
+        sharded = tree_map(lambda p: np.reshape(p, (self.num_devices, -1, *p.shape[1:])), particles)
+        res = jax.pmap(vmap_fn)(*sharded)
+        return tree_map(lambda r: np.reshape(r, (-1, *r.shape[2:])), res)
 
-    def _kernel_grad(self, kernel, x, y):
+    def _kernel_grad_fn(self, kernel, grad_fn=jax.grad):
+        # Differentiates the kernel once, giving a function of (x, y) that is shared by all particle pairs
         if self.kernel_fn.mode == 'norm':
-            return jax.grad(lambda x: kernel(x, y))(x)
+            return grad_fn(kernel)
         elif self.kernel_fn.mode == 'vector':
-            return jax.vmap(lambda i: jax.grad(lambda xi: kernel(xi, y[i])[i])(x[i]))(np.arange(x.shape[0]))
+            component_grad = grad_fn(lambda xi, yi, i: kernel(xi, yi)[i])
+            return lambda x, y: jax.vmap(component_grad)(x, y, np.arange(x.shape[0]))
+        else:
+            entry_grad = grad_fn(lambda x, y, l, m: kernel(x, y)[l, m])
+            return lambda x, y: jax.vmap(lambda l: np.sum(jax.vmap(lambda m: entry_grad(x, y, l, m)[m])
+                                                          (np.arange(x.shape[0]))))(np.arange(x.shape[0]))
+
+    def _use_fwd_force_mode(self, particles):
+        if self.force_mode == 'auto':
+            return particles.shape[-1] < _FWD_FORCE_MODE_MAX_DIM
+        return self.force_mode == 'fwd'
+
+    def _particle_forces(self, kernel, particles, particle_ljp_grads, y, fwd_mode=False):
+        batched_kernel = _batched_kernel(kernel)
+        if self.kernel_fn.mode == 'norm' and fwd_mode:
+            # Pushing the standard basis through jvp yields the kernel value alongside its gradient in one forward pass
+            basis = np.eye(particles.shape[-1], dtype=particles.dtype)
+            def kernel_value_and_grad(x):
+                kernel_val, kernel_grad = jax.vmap(lambda v: jax.jvp(lambda x: kernel(x, y), (x,), (v,)))(basis)
+                return kernel_val[0], kernel_grad
+            kernel_vals, kernel_grads = jax.vmap(kernel_value_and_grad)(particles)
+            return kernel_vals @ particle_ljp_grads, np.sum(kernel_grads, axis=0)
+        elif self.kernel_fn.mode == 'norm':
+            # A single reverse-mode sweep over the kernel values k(x, y) for all x yields every gradient of the repulsive sum
+            kernel_vals, kernel_vjp = jax.vjp(lambda xs: batched_kernel(xs, y), particles)
+            kernel_grads, = kernel_vjp(np.ones_like(kernel_vals))
+            return kernel_vals @ particle_ljp_grads, np.sum(kernel_grads, axis=0)
+        kernel_vals = batched_kernel(particles, y) # N x D (x D)
+        if self.kernel_fn.mode == 'vector':
+            attractive_force = np.sum(kernel_vals * particle_ljp_grads, axis=0)
         else:
-            return jax.vmap(lambda l: np.sum(jax.vmap(lambda m: jax.grad(lambda x: kernel(x, y)[l, m])(x)[m])
-                                            (np.arange(x.shape[0]))))(np.arange(x.shape[0]))
+            attractive_force = np.einsum('nde,ne->d', kernel_vals, particle_ljp_grads)
+        kernel_grad = self._kernel_grad_fn(kernel, jax.jacfwd if fwd_mode else jax.grad)
+        kernel_grads = jax.vmap(kernel_grad, in_axes=(0, None))(particles, y)
+        return attractive_force, np.sum(kernel_grads, axis=0)
+
+    def _batched_forces(self, batched_kernel, particles, particle_ljp_grads):
+        # Linearizing in all particles at once gives the N x N kernel matrix together with its jvp.
+        # Pushing the same basis direction through every particle x_i sums grad_x k(x_i, y) over i for each column y.
+        kernel_mat, kernel_jvp = jax.linearize(lambda xs: batched_kernel(xs, particles), particles)
+        basis = np.eye(particles.shape[-1], dtype=particles.dtype)
+        repulsive_force = jax.vmap(lambda e: np.sum(kernel_jvp(np.broadcast_to(e, particles.shape)), axis=0))(basis) # D x N
+        return kernel_mat.T @ particle_ljp_grads, repulsive_force.T
+
+    def _rbf_forces(self, particles, particle_ljp_grads):
+        bandwidth = self.kernel_fn.bandwidth(particles)
+        kernel_dtype = self.kernel_dtype if self.kernel_dtype is not None else particles.dtype
+        # The N x N block is computed in the kernel type, but reduced in the particle type
+        kernel_mat = np.exp(- sq_dists(particles, particles, kernel_dtype) / np.asarray(bandwidth, kernel_dtype)) # Symmetric N x N
+        kernel_mat = kernel_mat.astype(particles.dtype)
+        attractive_force = kernel_mat @ particle_ljp_grads
+        # sum_x grad_x k(x, y) = 2 / bandwidth * sum_x k(x, y) (y - x), which is invariant to shifting the particles,
+        # so they are centered to keep the cancellation between the two terms small
+        centered = particles - np.mean(particles, axis=0)
+        repulsive_force = 2 / bandwidth * (np.sum(kernel_mat, axis=-1, keepdims=True) * centered - kernel_mat @ centered)
+        return attractive_force, repulsive_force
 
     def _calc_particle_info(self, uparams, num_particles):
         uparam_keys = list(uparams.keys())
@@ -121,10 +311,10 @@ class SVGD:
             start_index = end_index
         return res
 
-    def _svgd_loss_and_grads(self, rng_key, unconstr_params, *args, **kwargs):
+    def _svgd_loss_and_grads(self, rng_key, unconstr_params, loss_temperature, repulsion_temperature, *args, **kwargs):
         # 0. Separate model and guide parameters, since only guide parameters are updated using Stein
-        classic_uparams = {p: v for p, v in unconstr_params.items() if p not in self.guide_param_names or self.classic_guide_params_fn(p)}
-        stein_uparams = {p: v for p, v in unconstr_params.items() if p not in classic_uparams}
+        classic_uparams = {p: unconstr_params[p] for p in self._classic_param_names}
+        stein_uparams = {p: unconstr_params[p] for p in self._stein_param_names}
         # 1. Collect each guide parameter into monolithic particles that capture correlations between parameter values across each individual particle
         stein_particles, unravel_pytree, unravel_pytree_batched = ravel_pytree(stein_uparams, batch_dims=1)
         particle_info = self._calc_particle_info(stein_uparams, stein_particles.shape[0])
@@ -132,44 +322,63 @@ class SVGD:
         # 2. Calculate loss and gradients for each parameter (broadcasting by num_loss_particles for increased variance reduction)
         def scaled_loss(rng_key, classic_params, stein_params):
             params = {**classic_params, **stein_params}
-            loss_val = self.loss.loss(rng_key, params, handlers.scale(self.model, self.loss_temperature), self.guide, *args, **kwargs, **self.static_kwargs)
+            loss_val = self.loss.loss(rng_key, params, handlers.scale(self.model, loss_temperature), self.guide, *args, **kwargs, **self.static_kwargs)
             return - loss_val
 
-        kernel_particle_loss_fn = lambda ps: scaled_loss(rng_key, self.constrain_fn(classic_uparams), self.constrain_fn(unravel_pytree(ps)))
-        loss, particle_ljp_grads = jax.vmap(jax.value_and_grad(kernel_particle_loss_fn))(stein_particles)
-        classic_param_grads = jax.vmap(lambda ps: jax.grad(lambda cps: 
-                                            scaled_loss(rng_key, self.constrain_fn(cps), self.constrain_fn(unravel_pytree(ps))))(classic_uparams))(stein_particles)
-        classic_param_grads = tree_map(jax.partial(np.mean, axis=0), classic_param_grads)
+        # Constrain classic parameters outside of the kernel loss function, which does not differentiate them
+        classic_params = self.constrain_fn(classic_uparams)
+        kernel_particle_loss_fn = lambda ps: scaled_loss(rng_key, classic_params, self.constrain_fn(unravel_pytree(ps)))
+        # A single pass over the particles computes the loss and gradients for both the particle and classic parameters
+        particle_loss_fn = lambda ps, cps: scaled_loss(rng_key, self.constrain_fn(cps), self.constrain_fn(unravel_pytree(ps)))
+        loss, (particle_ljp_grads, classic_param_grads) = self._map_particles(
+            lambda ps: jax.value_and_grad(particle_loss_fn, argnums=(0, 1))(ps, classic_uparams), stein_particles)
+        # Gradients are of the negated loss, so they are negated back as part of the mean
+        classic_param_grads = tree_map(lambda g: -np.mean(g, axis=0), classic_param_grads)
 
-        # 3. Calculate kernel on monolithic particle
-        kernel = self.kernel_fn.compute(stein_particles, particle_info, kernel_particle_loss_fn)
+        if self.fast_rbf:
+            # 3-4. Calculate the attractive and repulsive forces directly from the RBF kernel matrix
+            attractive_force, repulsive_force = self._rbf_forces(stein_particles, particle_ljp_grads)
+        else:
+            # 3. Calculate kernel on monolithic particle, preferring a batched kernel when it can be used.
+            fwd_mode = self._use_fwd_force_mode(stein_particles)
+            batched_kernel = None
+            # The batched kernel is differentiated in forward mode over the whole particle set, so it is not tiled or sharded
+            if fwd_mode and self.pairwise_tile is None and self.num_devices == 1:
+                batched_kernel = self.kernel_fn.compute_batched(stein_particles, particle_info, kernel_particle_loss_fn)
 
-        # 4. Calculate the attractive force and repulsive force on the monolithic particles
-        attractive_force = jax.vmap(lambda y: np.sum(jax.vmap(lambda x, x_ljp_grad: self._apply_kernel(kernel, x, y, x_ljp_grad))(stein_particles, particle_ljp_grads), axis=0))(stein_particles)
-        repulsive_force = jax.vmap(lambda y: np.sum(jax.vmap(lambda x: self.repulsion_temperature * self._kernel_grad(kernel, x, y))(stein_particles), axis=0))(stein_particles)
-        particle_grads = (attractive_force + repulsive_force) / self.num_stein_particles
+            # 4. Calculate the attractive force and repulsive force on the monolithic particles
+            if batched_kernel is not None:
+                attractive_force, repulsive_force = self._batched_forces(batched_kernel, stein_particles, particle_ljp_grads)
+            else:
+                kernel = self.kernel_fn.compute(stein_particles, particle_info, kernel_particle_loss_fn)
+                attractive_force, repulsive_force = self._map_particles(lambda y: self._particle_forces(kernel, stein_particles, particle_ljp_grads,
+                                                                                                   y, fwd_mode),
+                                                                        stein_particles, tile_size=self.pairwise_tile)
+        particle_grads = -(attractive_force + repulsion_temperature * repulsive_force) / self.num_stein_particles
 
         # 5. Decompose the monolithic particle forces back to concrete parameter values
         stein_param_grads = unravel_pytree_batched(particle_grads)
 
         # 6. Return loss and gradients (based on parameter forces)
-        res_grads = tree_map(lambda x: -x, {**classic_param_grads, **stein_param_grads})
+        res_grads = {**classic_param_grads, **stein_param_grads}
         return -np.mean(loss), res_grads
 
     def _score_sp_mcmc(self, rng_key, subset_idxs, stein_uparams, sp_mcmc_subset_uparams, classic_uparams,
                        *args, **kwargs):
         if self.sp_mode == 'local':
-            _, ksd = self._svgd_loss_and_grads(rng_key, {**sp_mcmc_subset_uparams, **classic_uparams}, *args, **kwargs)
+            _, ksd = self._svgd_loss_and_grads(rng_key, {**sp_mcmc_subset_uparams, **classic_uparams}, self.loss_temperature,
+                                               self.repulsion_temperature, *args, **kwargs)
         else:
             stein_uparams = {p: ops.index_update(v, subset_idxs, sp_mcmc_subset_uparams[:, mcmc_idx]) for p, v in stein_uparams.items() }
-            _, ksd = self._svgd_loss_and_grads(rng_key, {**stein_uparams, **classic_uparams}, *args, **kwargs)
+            _, ksd = self._svgd_loss_and_grads(rng_key, {**stein_uparams, **classic_uparams}, self.loss_temperature,
+                                               self.repulsion_temperature, *args, **kwargs)
         return ksd
 
 
     def _sp_mcmc(self, rng_key, unconstr_params, *args, **kwargs):
         # 0. Separate classical and stein parameters
-        classic_uparams = {p: v for p, v in unconstr_params.items() if p not in self.guide_param_names or self.classic_guide_params_fn(p)}
-        stein_uparams = {p: v for p, v in unconstr_params.items() if p not in classic_uparams}
+        classic_uparams = {p: unconstr_params[p] for p in self._classic_param_names}
+        stein_uparams = {p: unconstr_params[p] for p in self._stein_param_names}
 
         # Fix classical parameters for MCMC run
         self.mcmc.sampler._model = handlers.substitute(self.mcmc.sampler._model, self.constrain_fn(classic_uparams))
@@ -188,7 +397,8 @@ class SVGD:
             if self.sp_mcmc_crit == 'rand':
                 idxs = jax.random.shuffle(choice_key, np.arange(self.num_stein_particles))[:self.num_mcmc_particles]
             elif self.sp_mcmc_crit == 'infl':
-                _, grads = self._svgd_loss_and_grads(choice_key, unconstr_params, *args, **kwargs)
+                _, grads = self._svgd_loss_and_grads(choice_key, unconstr_params, self.loss_temperature, self.repulsion_temperature,
+                                                     *args, **kwargs)
                 ksd = np.linalg.norm(np.concatenate([np.reshape(grads[p], (self.num_stein_particles, -1)) for p in stein_uparams.keys()], axis=-1),
                                     ord=2, axis=-1)
                 idxs = np.argsort(ksd)[:self.num_mcmc_particles]
@@ -231,7 +441,7 @@ class SVGD:
         inv_transforms = {}
         guide_param_names = set()
         # NB: params in model_trace will be overwritten by params in guide_trace
-        for site in list(model_trace.values()) + list(guide_trace.values()):
+        for site in chain(model_trace.values(), guide_trace.values()):
             if site['type'] == 'param':
                 constraint = site['kwargs'].pop('constraint', constraints.real)
                 transform = biject_to(constraint)
@@ -244,14 +454,18 @@ class SVGD:
                 params[site['name']] = transform.inv(pval)
                 if site['name'] in guide_trace:
                     guide_param_names.add(site['name'])
-        self.guide_param_names = guide_param_names
-        self.constrain_fn = jax.partial(transform_fn, inv_transforms)
-        self.uconstrain_fn = jax.partial(transform_fn, transforms)
-        classic_uparam_names = {p for p in params.keys() if p not in self.guide_param_names or self.classic_guide_params_fn(p)}
+        self.guide_param_names = frozenset(guide_param_names)
+        self.constrain_fn = partial(transform_fn, inv_transforms)
+        self.uconstrain_fn = partial(transform_fn, transforms)
+        # Partition parameter names once in a stable order, so partitioning parameters at each step is just lookups
+        self._classic_param_names = tuple(p for p in params if p not in self.guide_param_names or self.classic_guide_params_fn(p))
+        classic_uparam_names = frozenset(self._classic_param_names)
+        self._stein_param_names = tuple(p for p in params if p not in classic_uparam_names)
         # Ensure not to sample parameters that should be classically updated
         sampler = self.sampler_fn(handlers.block(self.model, lambda site: site['name'] in classic_uparam_names), **self.sampler_kwargs)
         self.mcmc = MCMC(sampler, self.num_mcmc_warmup, self.num_mcmc_updates, num_chains=self.num_mcmc_particles, progress_bar=False, 
                          **self.mcmc_kwargs)
+        self._compiled_config = None # Compiled functions close over the partitioned parameter names, so they are rebuilt
         return SVGDState(self.optim.init(params), rng_key)
 
     def get_params(self, state):
@@ -274,13 +488,15 @@ class SVGD:
         :return: tuple of `(state, loss)`.
         """
         rng_key, rng_key_mcmc, rng_key_step = jax.random.split(state.rng_key, num=3)
-        params = self.optim.get_params(state.optim_state)
+        loss_and_grads_fn, update_fn = self._compiled_fns()
         # Run Stein Point MCMC
         if self.num_mcmc_particles > 0:
+            params = self.optim.get_params(state.optim_state)
             params = self._sp_mcmc(rng_key_mcmc, params, *args, **kwargs, **self.static_kwargs)
-        loss_val, grads = self._svgd_loss_and_grads(rng_key_step, params, 
-                                                    *args, **kwargs, **self.static_kwargs)
-        optim_state = self.optim.update(grads, state.optim_state)
+            loss_val, grads = loss_and_grads_fn(rng_key_step, params, *args, **kwargs)
+            optim_state = self.optim.update(grads, state.optim_state)
+        else:
+            optim_state, loss_val = update_fn(state.optim_state, rng_key_step, *args, **kwargs)
         return SVGDState(optim_state, rng_key), loss_val
 
     def run(self, rng_key, num_steps, *args, return_last=True, progbar=True, **kwargs):
@@ -290,13 +506,16 @@ class SVGD:
             losses = ops.index_update(losses, i, loss)
             return svgd_state, losses
         svgd_state = self.init(rng_key, *args, **kwargs)
-        losses = np.empty((num_steps,))
         if not progbar:
-            svgd_state, losses = fori_loop(0, num_steps, bodyfn, (svgd_state, losses))
+            # All steps are compiled into a single loop, collecting the loss of each step
+            svgd_state, losses = jax.lax.scan(lambda state, _: self.update(state, *args, **kwargs), svgd_state, None,
+                                              length=num_steps)
         else:
+            losses = np.empty((num_steps,))
+            jit_bodyfn = jax.jit(bodyfn)
             with tqdm.trange(num_steps) as t:
                 for i in t:
-                    svgd_state, losses = jax.jit(bodyfn)(i, (svgd_state, losses))
+                    svgd_state, losses = jit_bodyfn(i, (svgd_state, losses))
                     t.set_description('SVGD {:.5}'.format(losses[i]), refresh=False)
                     t.update()
         loss_res = losses[-1] if return_last else losses
@@ -312,8 +531,8 @@ class SVGD:
         :return: evaluate loss given the current parameter values (held within `state.optim_state`).
         """
         # we split to have the same seed as `update_fn` given a state
-        _, rng_key_eval = jax.random.split(state.rng_key)
+        _, _, rng_key_eval = jax.random.split(state.rng_key, num=3)
         params = self.get_params(state)
-        loss_val, _ = self._svgd_loss_and_grads(rng_key_eval, params, 
-                                                *args, **kwargs, **self.static_kwargs)
+        loss_and_grads_fn, _ = self._compiled_fns()
+        loss_val, _ = loss_and_grads_fn(rng_key_eval, params, *args, **kwargs)
         return loss_val
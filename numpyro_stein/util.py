@@ -1,9 +1,11 @@
 from collections import namedtuple
+from itertools import accumulate
+import numpy as onp
 import jax
 import jax.numpy as np
 from jax import lax
 from jax.dtypes import canonicalize_dtype
-from jax.tree_util import tree_flatten, tree_map, tree_unflatten
+from jax.tree_util import tree_flatten, tree_unflatten
 
 import numpyro
 import numpyro.distributions as dist
@@ -12,21 +14,26 @@ from numpyro.distributions.transforms import biject_to
 pytree_metadata = namedtuple('pytree_metadata', ['flat', 'shape', 'event_size', 'dtype'])
 
 
+def _leaf_metadata(leaf, batch_dims):
+    shape = np.shape(leaf)
+    return pytree_metadata(np.reshape(leaf, (*shape[:batch_dims], -1)), shape,
+                           int(onp.prod(shape[batch_dims:])), canonicalize_dtype(lax.dtype(leaf)))
+
+
 def _ravel_list(*leaves, batch_dims):
-    leaves_metadata = tree_map(lambda l: pytree_metadata(
-        np.reshape(l, (*np.shape(l)[:batch_dims], -1)), np.shape(l), 
-        np.prod(np.shape(l)[batch_dims:], dtype='int32'), canonicalize_dtype(lax.dtype(l))), leaves)
-    leaves_idx = np.cumsum(np.array((0,) + tuple(d.event_size for d in leaves_metadata)))
+    leaves_metadata = [_leaf_metadata(l, batch_dims) for l in leaves]
+    # Python ints, so the slice offsets are compile-time constants
+    leaves_idx = tuple(accumulate((0,) + tuple(m.event_size for m in leaves_metadata)))
+
+    split_points = leaves_idx[1:-1]
 
     def unravel_list(arr):
-        return [np.reshape(lax.dynamic_slice_in_dim(arr, leaves_idx[i], m.event_size),
-                           m.shape[batch_dims:]).astype(m.dtype)
-                for i, m in enumerate(leaves_metadata)]
+        return [np.reshape(piece, m.shape[batch_dims:]).astype(m.dtype)
+                for piece, m in zip(np.split(arr, split_points), leaves_metadata)]
 
     def unravel_list_batched(arr):
-        return [np.reshape(lax.dynamic_slice_in_dim(arr, leaves_idx[i], m.event_size, axis=batch_dims),
-                           m.shape).astype(m.dtype)
-                for i, m in enumerate(leaves_metadata)]
+        return [np.reshape(piece, m.shape).astype(m.dtype)
+                for piece, m in zip(np.split(arr, split_points, axis=batch_dims), leaves_metadata)]
 
     flat = np.concatenate([m.flat for m in leaves_metadata], axis=-1) if leaves_metadata else np.array([])
     return flat, unravel_list, unravel_list_batched
@@ -46,17 +53,33 @@ def ravel_pytree(pytree, *, batch_dims=0):
 
 def init_with_noise(init_strategy, noise_scale=1.0):
     def init(site, skip_param=False):
+        vals = init_strategy(site, skip_param=skip_param)
+        if vals is None:
+            return None
         if isinstance(site['fn'], dist.TransformedDistribution):
             fn = site['fn'].base_dist
         else:
             fn = site['fn']
-        vals = init_strategy(site, skip_param=skip_param)
-        if vals is not None:
-            base_transform = biject_to(fn.support)
-            unconstrained_init = numpyro.sample('_noisy_init', dist.Normal(loc=base_transform.inv(vals), scale=noise_scale))
-            return base_transform(unconstrained_init)
+        base_transform = biject_to(fn.support)
+        # A single draw of batched noise perturbs all components of the site at once
+        unconstrained_init = numpyro.sample('_noisy_init', dist.Normal(loc=base_transform.inv(vals), scale=noise_scale))
+        return base_transform(unconstrained_init)
     return init
 
+def sq_dists(xs, ys, dtype=None):
+    """
+    Computes the squared Euclidean distances between all rows of `xs` (N x D) and `ys` (M x D) from a single matrix product.
+    Both are first centered on a shared mean, which leaves the distances unchanged but avoids cancellation between
+    the terms of the expansion for particles far from the origin.
+    :param dtype: Floating point type to compute the distances in after centering (default None, meaning the input type)
+    """
+    center = (np.mean(xs, axis=0) + np.mean(ys, axis=0)) / 2
+    xs, ys = xs - center, ys - center
+    if dtype is not None:
+        xs, ys = xs.astype(dtype), ys.astype(dtype)
+    dists = np.expand_dims(np.sum(xs ** 2, axis=-1), axis=1) + np.expand_dims(np.sum(ys ** 2, axis=-1), axis=0) - 2 * xs @ ys.T
+    return np.maximum(dists, 0.) # N x M
+
 def sqrth(m):
     mlambda, mvec = np.linalg.eigh(m)
     if np.ndim(mlambda) >= 2: